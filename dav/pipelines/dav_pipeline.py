@@ -1,17 +1,41 @@
+import functools
 import torch
 import tqdm
 import numpy as np
 from diffusers import DiffusionPipeline
 from diffusers.utils import BaseOutput
 import matplotlib
+from typing import Union
 
 
-def colorize_depth(depth, cmap="Spectral"):
-    # colorize
+@functools.lru_cache()
+def colormap_lut(cmap="Spectral", device="cpu"):
+    # (cm.N, 3) uint8 lookup table of the colormap entries, kept on device
     cm = matplotlib.colormaps[cmap]
-    # (B, N, H, W, 3)
-    depth_colored = cm(depth, bytes=False)[..., 0:3]  # value from 0 to 1
-    return depth_colored
+    lut = (cm(np.arange(cm.N), bytes=False)[:, 0:3] * 255).astype(np.uint8)
+    return torch.from_numpy(lut).to(device)
+
+
+def colorize_depth_gpu(depth, cmap="Spectral"):
+    lut = colormap_lut(cmap, depth.device)
+    # same float -> entry mapping as matplotlib for values in [0, 1]
+    index = (depth * lut.shape[0]).long().clamp_(0, lut.shape[0] - 1)
+    # (..., 3)
+    return lut[index]
+
+
+def to_numpy(*tensors):
+    # queue every D2H copy into pinned memory and synchronize once
+    outputs = []
+    for tensor in tensors:
+        output = torch.empty(
+            tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda
+        )
+        output.copy_(tensor, non_blocking=True)
+        outputs.append(output)
+    if tensors[0].is_cuda:
+        torch.cuda.current_stream(tensors[0].device).synchronize()
+    return [output.numpy() for output in outputs]
 
 
 class DAVOutput(BaseOutput):
@@ -21,12 +45,12 @@ class DAVOutput(BaseOutput):
     Args:
         frames (`[List[PIL.Image.Image]`, `np.ndarray`]):
             List of denoised PIL images of length `batch_size` or NumPy array of shape `(batch_size, height, width,
-            num_channels)`.
+            num_channels)`. With `output_type="pt"` the fields are tensors left on the pipeline device.
     """
 
-    disparity: np.ndarray
-    disparity_colored: np.ndarray
-    image: np.ndarray
+    disparity: Union[np.ndarray, torch.Tensor]
+    disparity_colored: Union[np.ndarray, torch.Tensor]
+    image: Union[np.ndarray, torch.Tensor]
 
 
 class DAVPipeline(DiffusionPipeline):
@@ -44,25 +68,56 @@ class DAVPipeline(DiffusionPipeline):
         latent = latent.reshape(-1, num_frames, *latent.shape[1:])
         return latent
 
+    def auto_decode_chunk_size(self, latents, probe_chunk_size=2):
+        # decode a small probe chunk and size the rest from the remaining memory
+        device = latents.device
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base_bytes = torch.cuda.memory_allocated(device)
+        frame = self.vae.decode(
+            latents[:probe_chunk_size].to(self.vae.dtype),
+            num_frames=latents[:probe_chunk_size].shape[0],
+        ).sample
+        peak_bytes = torch.cuda.max_memory_allocated(device) - base_bytes
+        per_frame_bytes = max(peak_bytes // frame.shape[0], 1)
+
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        # blocks cached by the allocator are free for the decoder as well
+        free_bytes += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(
+            device
+        )
+        # keep some headroom for fragmentation
+        return frame, max(1, int(0.8 * free_bytes) // per_frame_bytes)
+
     def decode(self, latents, decode_chunk_size=16):
-        # [batch, frames, channels, height, width] -> [batch*frames, channels, height, width]
-        num_frames = latents.shape[1]
-        latents = latents.flatten(0, 1)
+        # [batch, frames, channels, height, width]
         latents = latents / self.vae.config.scaling_factor
 
-        # decode decode_chunk_size frames at a time to avoid OOM
+        # decode decode_chunk_size frames at a time to avoid OOM, chunks never
+        # span two samples since the temporal decoder mixes frames in a chunk
         frames = []
-        for i in range(0, latents.shape[0], decode_chunk_size):
-            num_frames_in = latents[i : i + decode_chunk_size].shape[0]
-            frame = self.vae.decode(
-                latents[i : i + decode_chunk_size].to(self.vae.dtype),
-                num_frames=num_frames_in,
-            ).sample
-            frames.append(frame)
+        for sample_latents in latents:
+            start = 0
+            if not decode_chunk_size:
+                if latents.device.type == "cuda":
+                    frame, decode_chunk_size = self.auto_decode_chunk_size(
+                        sample_latents
+                    )
+                    frames.append(frame)
+                    start = frame.shape[0]
+                else:
+                    decode_chunk_size = 16
+            for i in range(start, sample_latents.shape[0], decode_chunk_size):
+                num_frames_in = sample_latents[i : i + decode_chunk_size].shape[0]
+                frame = self.vae.decode(
+                    sample_latents[i : i + decode_chunk_size].to(self.vae.dtype),
+                    num_frames=num_frames_in,
+                ).sample
+                frames.append(frame)
         frames = torch.cat(frames, dim=0)
 
         # [batch, frames, channels, height, width]
-        frames = frames.reshape(-1, num_frames, *frames.shape[1:])
+        frames = frames.reshape(latents.shape[0], -1, *frames.shape[1:])
         return frames.to(torch.float32)
 
     def single_infer(self, rgb, position_ids=None, num_inference_steps=None):
@@ -136,11 +191,15 @@ class DAVPipeline(DiffusionPipeline):
         num_interp_frames,
         decode_chunk_size,
         num_inference_steps,
+        output_type="np",
+        drop_vae_encoder=False,
     ):
-        self.vae.to(dtype=torch.float16)
+        if self.vae.dtype == torch.float32:
+            self.vae.to(dtype=torch.float16)
 
-        # (1, N, 3, H, W)
-        image = image.unsqueeze(0)
+        # (B, N, 3, H, W), a single clip is (N, 3, H, W)
+        if image.dim() == 4:
+            image = image.unsqueeze(0)
         B, N = image.shape[:2]
         rgb = image * 2 - 1  # [-1, 1]
 
@@ -162,9 +221,10 @@ class DAVPipeline(DiffusionPipeline):
                 key_frame_indices.append(i)
                 key_frame_indices.append(i + num_interp_frames + 1)
 
-            key_frame_indices = torch.tensor(key_frame_indices, device=rgb.device)
-
-            sorted_key_frame_indices, origin_indices = torch.sort(key_frame_indices)
+            # keep the python list for slicing, indexing a device tensor syncs the host
+            sorted_key_frame_indices, origin_indices = torch.sort(
+                torch.tensor(key_frame_indices, device=rgb.device)
+            )
             key_rgb = rgb[:, sorted_key_frame_indices]
             key_depth_latent = self.single_infer(
                 key_rgb,
@@ -224,20 +284,36 @@ class DAVPipeline(DiffusionPipeline):
             image = image[:, key_frame_indices[0] + 1 : key_frame_indices[-1]]
             assert depth_latent.shape[1] == image.shape[1]
 
+        if drop_vae_encoder:
+            # all frames are encoded by now, free the encoder for the decoder,
+            # later calls to this pipeline can no longer encode
+            del self.vae.encoder, self.vae.quant_conv
+            torch.cuda.empty_cache()
+
         disparity = self.decode(depth_latent, decode_chunk_size=decode_chunk_size)
         disparity = disparity.mean(dim=2, keepdim=False)
         disparity = torch.clamp(disparity * 0.5 + 0.5, 0.0, 1.0)
 
-        # (N, H, W)
-        disparity = disparity.squeeze(0)
-        # (N, H, W, 3)
-        mid_d, max_d = disparity.min(), disparity.max()
-        disparity_colored = torch.clamp((max_d - disparity) / (max_d - mid_d), 0.0, 1.0)
-        disparity_colored = colorize_depth(disparity_colored.cpu().numpy())
-        disparity_colored = (disparity_colored * 255).astype(np.uint8)
-        image = image.squeeze(0).permute(0, 2, 3, 1).cpu().numpy()
-        image = (image * 255).astype(np.uint8)
-        disparity = disparity.cpu().numpy()
+        # normalize each sample of the batch separately, (B, 1, 1, 1)
+        mid_d = disparity.flatten(1).min(dim=1).values.view(-1, 1, 1, 1)
+        max_d = disparity.flatten(1).max(dim=1).values.view(-1, 1, 1, 1)
+        # guard constant disparity, a zero range would give NaN color indices
+        disparity_range = (max_d - mid_d).clamp_min(1e-6)
+        disparity_colored = torch.clamp((max_d - disparity) / disparity_range, 0.0, 1.0)
+
+        # (B * N, H, W)
+        disparity = disparity.flatten(0, 1)
+        disparity_colored = disparity_colored.flatten(0, 1)
+        # (B * N, H, W, 3) uint8
+        disparity_colored = colorize_depth_gpu(disparity_colored)
+        image = image.flatten(0, 1).permute(0, 2, 3, 1)
+        # round, fp16 k / 255 * 255 can land just below k
+        image = image.float().mul_(255).round_().to(torch.uint8)
+
+        if output_type == "np":
+            disparity, disparity_colored, image = to_numpy(
+                disparity, disparity_colored, image
+            )
 
         return DAVOutput(
             disparity=disparity,
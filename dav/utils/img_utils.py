@@ -84,6 +84,16 @@ def read_image(image_path):
     return [frame]
 
 
+def read_image_size(image_path):
+    # only parses the header, EXIF rotation is applied like cv2.imread does
+    with Image.open(image_path) as img:
+        w, h = img.size
+        if img.getexif().get(0x0112) in (5, 6, 7, 8):
+            w, h = h, w
+    # (H, W)
+    return h, w
+
+
 def write_video(video_path, frames, fps):
     tmp_dir = os.path.join(os.path.dirname(video_path), "tmp")
     os.makedirs(tmp_dir, exist_ok=True)
@@ -0,0 +1,272 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import torch
+from diffusers.utils import BaseOutput
+
+_ORT_DTYPES = {
+    torch.float16: np.float16,
+    torch.float32: np.float32,
+    torch.int64: np.int64,
+}
+
+
+class UNetOutput(BaseOutput):
+    sample: torch.Tensor
+
+
+class _UNetExportWrapper(torch.nn.Module):
+    def __init__(self, unet, with_position_ids):
+        super().__init__()
+        self.unet = unet
+        self.with_position_ids = with_position_ids
+
+    def forward(self, sample, timestep, encoder_hidden_states, position_ids=None):
+        return self.unet(
+            sample,
+            timestep,
+            encoder_hidden_states=encoder_hidden_states,
+            position_ids=position_ids if self.with_position_ids else None,
+            return_dict=False,
+        )[0]
+
+
+def export_unet_onnx(unet, onnx_path, with_position_ids=False, opset_version=17):
+    """
+    Export a UNetSpatioTemporalRopeConditionModel to ONNX with dynamic batch, frame
+    and spatial axes, in the dtype and on the device the unet currently uses.
+    """
+    config = unet.config
+    # (B, F, C, h, w), h is not a multiple of 2**num_upsamplers so the trace takes
+    # the explicit upsample_size path, which is exact for every latent size, a
+    # multiple-of-8 trace would bake in plain x2 upsampling, B and F avoid 1 so
+    # they are not specialized as broadcast dims
+    sample = torch.randn(
+        2, 3, config.in_channels, 36, 40, dtype=unet.dtype, device=unet.device
+    )
+    timestep = torch.tensor(1.0, dtype=torch.float32, device=unet.device)
+    encoder_hidden_states = torch.zeros(
+        2, 1, config.cross_attention_dim, dtype=unet.dtype, device=unet.device
+    )
+    inputs = (sample, timestep, encoder_hidden_states)
+    input_names = ["sample", "timestep", "encoder_hidden_states"]
+    dynamic_axes = {
+        "sample": {0: "batch", 1: "frames", 3: "height", 4: "width"},
+        "encoder_hidden_states": {0: "batch"},
+        "out_sample": {0: "batch", 1: "frames", 3: "height", 4: "width"},
+    }
+    if with_position_ids:
+        inputs += (torch.arange(3, device=unet.device)[None].repeat(2, 1),)
+        input_names.append("position_ids")
+        dynamic_axes["position_ids"] = {0: "batch", 1: "frames"}
+
+    with torch.inference_mode():
+        torch.onnx.export(
+            _UNetExportWrapper(unet, with_position_ids),
+            inputs,
+            onnx_path,
+            input_names=input_names,
+            output_names=["out_sample"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+
+class ORTUNet:
+    """
+    Drop-in replacement for the unet forward used by DAVPipeline, backed by an
+    ONNX Runtime session that reads and writes torch CUDA tensors in place.
+    """
+
+    def __init__(self, onnx_path, unet, with_position_ids=False):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError(
+                "ORTUNet requires onnxruntime-gpu, "
+                "install it with `pip install onnxruntime-gpu`."
+            )
+
+        self.config = unet.config
+        self.dtype = unet.dtype
+        self.device = unet.device
+        self.with_position_ids = with_position_ids
+
+        # run on torch's stream so inputs are ready without an explicit sync
+        stream = str(torch.cuda.current_stream(self.device).cuda_stream)
+        providers = [
+            (
+                "CUDAExecutionProvider",
+                {"device_id": self.device.index or 0, "user_compute_stream": stream},
+            )
+        ]
+        if "TensorrtExecutionProvider" in ort.get_available_providers():
+            providers.insert(
+                0,
+                (
+                    "TensorrtExecutionProvider",
+                    {
+                        "device_id": self.device.index or 0,
+                        "user_compute_stream": stream,
+                        "trt_fp16_enable": self.dtype == torch.float16,
+                        "trt_engine_cache_enable": True,
+                        "trt_engine_cache_path": os.path.dirname(
+                            os.path.abspath(onnx_path)
+                        ),
+                    },
+                ),
+            )
+        self.session = ort.InferenceSession(onnx_path, providers=providers)
+
+    def _bind(self, binding, name, tensor):
+        binding.bind_input(
+            name,
+            device_type="cuda",
+            device_id=tensor.device.index or 0,
+            element_type=_ORT_DTYPES[tensor.dtype],
+            shape=tuple(tensor.shape),
+            buffer_ptr=tensor.data_ptr(),
+        )
+
+    def to(self, *args, **kwargs):
+        # the session is bound to its device and dtype, only accept a no-op move
+        device, dtype, _, _ = torch._C._nn._parse_to(*args, **kwargs)
+        if device is not None and (
+            device.type != self.device.type
+            or device.index not in (None, self.device.index)
+        ):
+            raise ValueError(
+                f"ORTUNet is bound to {self.device}, cannot move to {device}."
+            )
+        if dtype is not None and dtype != self.dtype:
+            raise ValueError(f"ORTUNet runs in {self.dtype}, cannot cast to {dtype}.")
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+    def forward(self, sample, timestep, encoder_hidden_states, position_ids=None):
+        B, F = sample.shape[:2]
+        sample = sample.contiguous()
+        timestep = torch.as_tensor(timestep, device=self.device)
+        timestep = timestep.reshape(()).to(torch.float32).contiguous()
+        encoder_hidden_states = encoder_hidden_states.contiguous()
+        out_sample = torch.empty(
+            (B, F, self.config.out_channels, *sample.shape[3:]),
+            dtype=sample.dtype,
+            device=sample.device,
+        )
+
+        binding = self.session.io_binding()
+        self._bind(binding, "sample", sample)
+        self._bind(binding, "timestep", timestep)
+        self._bind(binding, "encoder_hidden_states", encoder_hidden_states)
+        if self.with_position_ids:
+            if position_ids is None:
+                # (B, F), same default as TransformerSpatioTemporalRopeModel
+                position_ids = torch.arange(F, device=self.device)[None].repeat(B, 1)
+            position_ids = position_ids.to(torch.int64).contiguous()
+            self._bind(binding, "position_ids", position_ids)
+        binding.bind_output(
+            "out_sample",
+            device_type="cuda",
+            device_id=out_sample.device.index or 0,
+            element_type=_ORT_DTYPES[out_sample.dtype],
+            shape=tuple(out_sample.shape),
+            buffer_ptr=out_sample.data_ptr(),
+        )
+        self.session.run_with_iobinding(binding)
+        return UNetOutput(sample=out_sample)
+
+
+def check_ort_unet(ort_unet, unet, num_frames, size=(60, 80), rtol=1e-2):
+    """
+    Compare ORTUNet against the torch unet and raise if they disagree. Runs on a
+    latent that is not a multiple of 8, e.g. the (60, 80) latent of a 480x640 crop,
+    at batch and frame counts other than the export trace.
+    """
+    config = unet.config
+    generator = torch.Generator(device=unet.device).manual_seed(0)
+    # (B, F) pairs: a pipeline window and a batch of independent images
+    for batch_size, frames in ((1, num_frames), (3, 2)):
+        sample = torch.randn(
+            (batch_size, frames, config.in_channels, *size),
+            generator=generator,
+            dtype=unet.dtype,
+            device=unet.device,
+        )
+        timestep = torch.tensor(1.0, dtype=torch.float32, device=unet.device)
+        encoder_hidden_states = torch.zeros(
+            batch_size,
+            1,
+            config.cross_attention_dim,
+            dtype=unet.dtype,
+            device=unet.device,
+        )
+        position_ids = None
+        if ort_unet.with_position_ids:
+            # spaced like key frame indices
+            position_ids = torch.arange(frames, device=unet.device) * 3
+            position_ids = position_ids[None].repeat(batch_size, 1)
+
+        with torch.inference_mode():
+            expected = unet(
+                sample,
+                timestep,
+                encoder_hidden_states=encoder_hidden_states,
+                position_ids=position_ids,
+            ).sample.float()
+            actual = ort_unet(
+                sample,
+                timestep,
+                encoder_hidden_states=encoder_hidden_states,
+                position_ids=position_ids,
+            ).sample.float()
+        error = (actual - expected).norm() / expected.norm().clamp_min(1e-6)
+        error = error.item()
+        if not error < rtol:
+            raise RuntimeError(
+                f"ONNX Runtime unet differs from torch at batch {batch_size}, "
+                f"{frames} frames, {size} latent, relative error {error:.3g}."
+            )
+
+
+def load_ort_unet(
+    unet, onnx_dir, name, model_base, num_frames, with_position_ids=False
+):
+    """
+    Export the unet to its own cache directory on first use, then wrap it in an
+    ORTUNet checked against the torch unet at num_frames frames.
+    """
+    if unet.dtype not in (torch.float16, torch.float32):
+        raise ValueError(f"ONNX Runtime unets support fp16 or fp32, got {unet.dtype}.")
+
+    # external weight files are named after initializers, which both unets share,
+    # so every model gets its own directory keyed on checkpoint and dtype
+    key = f"{model_base}|{unet.dtype}|{with_position_ids}"
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    dtype_name = str(unet.dtype).split(".")[-1]
+    model_dir = os.path.join(onnx_dir, f"{name}-{dtype_name}-{key}")
+    onnx_path = os.path.join(model_dir, "model.onnx")
+
+    if not os.path.exists(onnx_path):
+        # export to a temporary directory, only a complete export is renamed
+        tmp_dir = f"{model_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            export_unet_onnx(
+                unet,
+                os.path.join(tmp_dir, "model.onnx"),
+                with_position_ids=with_position_ids,
+            )
+            shutil.rmtree(model_dir, ignore_errors=True)
+            os.replace(tmp_dir, model_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    ort_unet = ORTUNet(onnx_path, unet, with_position_ids=with_position_ids)
+    check_ort_unet(ort_unet, unet, num_frames)
+    return ort_unet
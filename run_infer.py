@@ -1,25 +1,79 @@
 import argparse
+import collections
 import logging
 import os
-import random
 
 from easydict import EasyDict
 import numpy as np
 import torch
+import torch.nn.functional as F
 from dav.pipelines import DAVPipeline
 from dav.models import UNetSpatioTemporalRopeConditionModel
 from diffusers import AutoencoderKLTemporalDecoder, FlowMatchEulerDiscreteScheduler
-from dav.utils import img_utils
+from dav.utils import img_utils, ort_utils
 
 
 def seed_all(seed: int = 0):
     """
     Set random seeds of all components.
     """
-    random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+
+
+def prepare_image_tensor(image, device, dtype, max_resolution, chunk_size=16):
+    """
+    Resize and crop same-sized RGB uint8 frames on device like imresize_max and
+    imcrop_multi, returns a normalized (N, 3, H, W) tensor.
+    """
+    h, w = image[0].shape[:2]
+    scale = min(max_resolution / max(h, w), 1.0)
+    size = (int(h * scale), int(w * scale))
+    crop_h, crop_w = size[0] // 32 * 32, size[1] // 32 * 32
+    start_h, start_w = (size[0] - crop_h) // 2, (size[1] - crop_w) // 2
+
+    image_tensor = torch.empty(
+        (len(image), 3, crop_h, crop_w), dtype=dtype, device=device
+    )
+    # upload raw uint8 frames in chunks to bound the float32 working set
+    for i in range(0, len(image), chunk_size):
+        frames = image[i : i + chunk_size]
+        # stack straight into pinned memory, one host copy per chunk
+        chunk = torch.empty((len(frames), h, w, 3), dtype=torch.uint8, pin_memory=True)
+        np.stack(frames, out=chunk.numpy())
+        chunk = chunk.to(device, non_blocking=True).permute(0, 3, 1, 2)
+        if size != (h, w):
+            chunk = F.interpolate(
+                chunk.float(), size=size, mode="bilinear", antialias=True
+            )
+        chunk = chunk[:, :, start_h : start_h + crop_h, start_w : start_w + crop_w]
+        # normalize and cast to the inference dtype in a single kernel
+        torch.mul(chunk, 1.0 / 255.0, out=image_tensor[i : i + chunk_size])
+    return image_tensor
+
+
+def merge_outputs(pipe_out):
+    """
+    Place input frames and colored disparity side by side, (N, H, 2 * W, 3).
+    """
+    merged = torch.cat([pipe_out.image, pipe_out.disparity_colored], dim=2)
+    # one async copy into a preallocated pinned buffer, synced before writing
+    merged_host = torch.empty(merged.shape, dtype=torch.uint8, pin_memory=True)
+    merged_host.copy_(merged, non_blocking=True)
+    torch.cuda.current_stream(merged.device).synchronize()
+    return merged_host.numpy()
+
+
+def to_channels_last(module: torch.nn.Module):
+    """
+    Convert 2D conv weights to channels_last, temporal Conv3d weights are left as-is.
+    """
+    for m in module.modules():
+        if isinstance(m, torch.nn.Conv2d):
+            m.weight.data = m.weight.data.contiguous(memory_format=torch.channels_last)
+    return module
 
 
 if "__main__" == __name__:
@@ -38,7 +92,10 @@ if "__main__" == __name__:
 
     # data setting
     parser.add_argument(
-        "--data_path", type=str, required=True, help="input data directory."
+        "--data_path",
+        type=str,
+        required=True,
+        help="Input video, image or directory of images.",
     )
 
     parser.add_argument(
@@ -62,7 +119,7 @@ if "__main__" == __name__:
         "--decode_chunk_size",
         type=int,
         default=16,
-        help="Number of frames to decode per forward",
+        help="Number of frames to decode per forward, 0 picks it from free GPU memory",
     )
     parser.add_argument(
         "--num_interp_frames",
@@ -76,6 +133,12 @@ if "__main__" == __name__:
         default=6,
         help="Number of frames to overlap between windows",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="Number of same-sized images per forward when data_path is a directory",
+    )
     parser.add_argument(
         "--max_resolution",
         type=int,
@@ -83,9 +146,46 @@ if "__main__" == __name__:
         help="Maximum resolution for inference.",
     )
 
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="fp16",
+        choices=["fp16", "bf16"],
+        help="Inference precision, use bf16 on Ampere or newer if fp16 overflows.",
+    )
+
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the unets with torch.compile, slower first run but faster denoising.",
+    )
+
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help="Run the unets with ONNX Runtime, exported models are cached here.",
+    )
+
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Quantize unet linear weights to int8 with torchao, best with --compile.",
+    )
+
+    parser.add_argument(
+        "--drop_vae_encoder",
+        action="store_true",
+        help="Free the VAE encoder before the final decode to leave more memory for it.",
+    )
+
     parser.add_argument("--seed", type=int, default=None, help="Random seed.")
 
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch_size must be at least 1.")
+    if args.int8 and args.onnx_dir is not None:
+        parser.error("--int8 is not supported with --onnx_dir.")
     cfg = EasyDict(vars(args))
 
     if cfg.seed is None:
@@ -96,19 +196,22 @@ if "__main__" == __name__:
 
     device_type = "cuda"
     device = torch.device(device_type)
+    dtype = torch.bfloat16 if cfg.dtype == "bf16" else torch.float16
 
     os.makedirs(cfg.output_dir, exist_ok=True)
     logging.info(f"output dir = {cfg.output_dir}")
 
-    vae = AutoencoderKLTemporalDecoder.from_pretrained(cfg.model_base, subfolder="vae")
+    vae = AutoencoderKLTemporalDecoder.from_pretrained(
+        cfg.model_base, subfolder="vae", torch_dtype=dtype
+    )
     scheduler = FlowMatchEulerDiscreteScheduler.from_pretrained(
         cfg.model_base, subfolder="scheduler"
     )
     unet = UNetSpatioTemporalRopeConditionModel.from_pretrained(
-        cfg.model_base, subfolder="unet"
+        cfg.model_base, subfolder="unet", torch_dtype=dtype
     )
     unet_interp = UNetSpatioTemporalRopeConditionModel.from_pretrained(
-        cfg.model_base, subfolder="unet_interp"
+        cfg.model_base, subfolder="unet_interp", torch_dtype=dtype
     )
     pipe = DAVPipeline(
         vae=vae,
@@ -116,60 +219,144 @@ if "__main__" == __name__:
         unet_interp=unet_interp,
         scheduler=scheduler,
     )
-    pipe = pipe.to(device)
-
-    file_name = cfg.data_path.split("/")[-1].split(".")[0]
-    is_video = cfg.data_path.endswith(".mp4")
-    if is_video:
-        num_interp_frames = cfg.num_interp_frames
-        num_overlap_frames = cfg.num_overlap_frames
-        num_frames = cfg.num_frames
-        assert num_frames % 2 == 0, "num_frames should be even."
-        assert (
-            2 <= num_overlap_frames <= (num_interp_frames + 2 + 1) // 2
-        ), "Invalid frame overlap."
-        max_frames = (num_interp_frames + 2 - num_overlap_frames) * (num_frames // 2)
-        image, fps = img_utils.read_video(cfg.data_path, max_frames=max_frames)
-    else:
-        image = img_utils.read_image(cfg.data_path)
-
-    image = img_utils.imresize_max(image, cfg.max_resolution)
-    image = img_utils.imcrop_multi(image)
-    image_tensor = np.ascontiguousarray(
-        [_img.transpose(2, 0, 1) / 255.0 for _img in image]
-    )
-    image_tensor = torch.from_numpy(image_tensor).to(device)
-
-    with torch.no_grad(), torch.autocast(device_type=device_type, dtype=torch.float16):
-        pipe_out = pipe(
-            image_tensor,
-            num_frames=cfg.num_frames,
-            num_overlap_frames=cfg.num_overlap_frames,
-            num_interp_frames=cfg.num_interp_frames,
-            decode_chunk_size=cfg.decode_chunk_size,
-            num_inference_steps=cfg.denoise_steps,
+    pipe = pipe.to(device, dtype=dtype)
+    to_channels_last(pipe.unet)
+    to_channels_last(pipe.unet_interp)
+    if cfg.int8:
+        try:
+            from torchao.quantization import int8_weight_only, quantize_
+        except ImportError:
+            raise ImportError(
+                "--int8 requires torchao, install it with `pip install torchao`."
+            )
+        quantize_(pipe.unet, int8_weight_only())
+        quantize_(pipe.unet_interp, int8_weight_only())
+    use_ort = False
+    if cfg.onnx_dir is not None:
+        try:
+            unet_ort = ort_utils.load_ort_unet(
+                pipe.unet,
+                cfg.onnx_dir,
+                "unet",
+                cfg.model_base,
+                num_frames=cfg.num_frames,
+                with_position_ids=True,
+            )
+            unet_interp_ort = ort_utils.load_ort_unet(
+                pipe.unet_interp,
+                cfg.onnx_dir,
+                "unet_interp",
+                cfg.model_base,
+                num_frames=cfg.num_interp_frames + 2,
+            )
+            pipe.unet, pipe.unet_interp = unet_ort, unet_interp_ort
+            use_ort = True
+            # drop the torch weights, the sessions hold their own copy
+            del unet, unet_interp
+            torch.cuda.empty_cache()
+        except Exception as e:
+            logging.warning(f"ONNX Runtime unets unavailable, using torch.compile: {e}")
+            # release a session that loaded before the failure
+            unet_ort = unet_interp_ort = None
+            torch.cuda.empty_cache()
+            cfg.compile = True
+    # ORTUNet calls into onnxruntime, which dynamo cannot trace
+    if cfg.compile and not use_ort:
+        # key frame and interpolation windows run the unets at different shapes
+        torch._dynamo.config.cache_size_limit = 64
+        pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+        pipe.unet_interp = torch.compile(
+            pipe.unet_interp, mode="reduce-overhead", fullgraph=True
         )
 
-    disparity = pipe_out.disparity
-    disparity_colored = pipe_out.disparity_colored
-    image = pipe_out.image
-    # (N, H, 2 * W, 3)
-    merged = np.concatenate(
-        [
-            image,
-            disparity_colored,
-        ],
-        axis=2,
-    )
-
-    if is_video:
-        img_utils.write_video(
-            os.path.join(cfg.output_dir, f"{file_name}.mp4"),
-            merged,
-            fps,
+    def run_pipe(image_tensor, last=True):
+        with torch.inference_mode():
+            return pipe(
+                image_tensor,
+                num_frames=cfg.num_frames,
+                num_overlap_frames=cfg.num_overlap_frames,
+                num_interp_frames=cfg.num_interp_frames,
+                decode_chunk_size=cfg.decode_chunk_size,
+                num_inference_steps=cfg.denoise_steps,
+                output_type="pt",
+                drop_vae_encoder=cfg.drop_vae_encoder and last,
+            )
+
+    if os.path.isdir(cfg.data_path):
+        # group images by header size, pixels are only decoded per batch
+        groups = {}
+        for img_file in sorted(os.listdir(cfg.data_path)):
+            if not img_file.lower().endswith((".jpg", ".jpeg", ".png")):
+                continue
+            img_path = os.path.join(cfg.data_path, img_file)
+            groups.setdefault(img_utils.read_image_size(img_path), []).append(img_file)
+        # a.jpg and a.png would both write a.png, keep the extension for those
+        stem_counts = collections.Counter(
+            os.path.splitext(img_file)[0]
+            for img_files in groups.values()
+            for img_file in img_files
         )
+
+        batches = [
+            img_files[i : i + cfg.batch_size]
+            for img_files in groups.values()
+            for i in range(0, len(img_files), cfg.batch_size)
+        ]
+        for batch_idx, batch in enumerate(batches):
+            # header sizes can disagree with the decoded pixels, e.g. when EXIF
+            # rotation is handled differently, so split by the decoded shape
+            sub_batches = {}
+            for img_file in batch:
+                frame = img_utils.read_image(os.path.join(cfg.data_path, img_file))[0]
+                sub_batches.setdefault(frame.shape, []).append((img_file, frame))
+
+            for sub_idx, items in enumerate(sub_batches.values()):
+                img_files, image = zip(*items)
+                # (B, 1, 3, H, W), images are independent samples
+                image_tensor = prepare_image_tensor(
+                    image, device, dtype, cfg.max_resolution
+                )
+                image_tensor = image_tensor.unsqueeze(1)
+                last = batch_idx == len(batches) - 1
+                last = last and sub_idx == len(sub_batches) - 1
+                merged = merge_outputs(run_pipe(image_tensor, last=last))
+                for img_file, frame in zip(img_files, merged):
+                    name, ext = os.path.splitext(img_file)
+                    if stem_counts[name] > 1:
+                        name = f"{name}_{ext[1:]}"
+                    img_utils.write_image(
+                        os.path.join(cfg.output_dir, f"{name}.png"), frame
+                    )
     else:
-        img_utils.write_image(
-            os.path.join(cfg.output_dir, f"{file_name}.png"),
-            merged[0],
-        )
+        file_name, ext = os.path.splitext(os.path.basename(cfg.data_path))
+        is_video = ext.lower() == ".mp4"
+        if is_video:
+            num_interp_frames = cfg.num_interp_frames
+            num_overlap_frames = cfg.num_overlap_frames
+            num_frames = cfg.num_frames
+            assert num_frames % 2 == 0, "num_frames should be even."
+            assert (
+                2 <= num_overlap_frames <= (num_interp_frames + 2 + 1) // 2
+            ), "Invalid frame overlap."
+            max_frames = (num_interp_frames + 2 - num_overlap_frames) * (
+                num_frames // 2
+            )
+            image, fps = img_utils.read_video(cfg.data_path, max_frames=max_frames)
+        else:
+            image = img_utils.read_image(cfg.data_path)
+
+        # (N, 3, H, W)
+        image_tensor = prepare_image_tensor(image, device, dtype, cfg.max_resolution)
+        merged = merge_outputs(run_pipe(image_tensor))
+
+        if is_video:
+            img_utils.write_video(
+                os.path.join(cfg.output_dir, f"{file_name}.mp4"),
+                merged,
+                fps,
+            )
+        else:
+            img_utils.write_image(
+                os.path.join(cfg.output_dir, f"{file_name}.png"),
+                merged[0],
+            )
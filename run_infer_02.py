@@ -118,8 +118,8 @@ if "__main__" == __name__:
     )
     pipe = pipe.to(device)
 
-    file_name = cfg.data_path.split("/")[-1].split(".")[0]
-    is_video = cfg.data_path.endswith(".mp4")
+    file_name, ext = os.path.splitext(os.path.basename(cfg.data_path))
+    is_video = ext.lower() == ".mp4"
     if is_video:
         num_interp_frames = cfg.num_interp_frames
         num_overlap_frames = cfg.num_overlap_frames